@@ -1,114 +1,587 @@
 import os
+import codecs
 import json
+import hashlib
+import fnmatch
 import requests
+from requests.adapters import HTTPAdapter
 import re
-from openai import OpenAI
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Bump when the prompt template changes so cached reviews are invalidated
+PROMPT_VERSION = "2"
+# Model for larger diffs; set REVIEW_MODEL=gpt-4o-mini to use the small model throughout
+MODEL = os.environ.get('REVIEW_MODEL', 'gpt-4o')
+# Diffs with fewer changed lines than this are reviewed by the smaller model
+SMALL_MODEL = "gpt-4o-mini"
+SMALL_DIFF_LINES = 300
+# Output budget grows with the diff size between these bounds
+MIN_OUTPUT_TOKENS = 1024
+MAX_OUTPUT_TOKENS = 4096
+# Only deterministic (temperature 0) completions are cached
+TEMPERATURE = 0
+CACHE_DIR = os.path.expanduser("~/.cache/pr-review")
+CACHE_TTL = 7 * 24 * 3600
+
+# Changes under this prefix (the bot's own workflow/scripts) are never reviewed
+EXCLUDED_PREFIX = '.github/'
+
+# Per-file budget for diff content sent to the model
+MAX_HUNK_LINES = 200
+MAX_HUNK_BYTES = 8 * 1024
+# Overall budget for the diff in the prompt; tokens are estimated from characters
+MAX_PROMPT_TOKENS = 8000
+CHARS_PER_TOKEN = 4
+MIN_SNIPPET_LINES = 3
+# "full-diff" sends the truncated diff; "compact" only the start of each file
+REVIEW_STRATEGY = os.environ.get('REVIEW_STRATEGY', 'full-diff')
+COMPACT_HUNK_LINES = 20
+MAX_DESCRIPTION_CHARS = 2000
+# Generated/vendored files are counted in the summary but not sent to the model
+GENERATED_PATTERNS = ('*.lock', '*.min.js', '*.min.css', 'package-lock.json', '*.snap', '*.generated.*')
+# Extended diff headers that add nothing beyond the `diff --git` line
+REDUNDANT_HEADER_PREFIXES = ('index ', '--- ', '+++ ')
+MAX_HEADER_LINES = 10
+# The post-image side of a `diff --git a/X b/Y` line. Git C-quotes paths
+# with special characters ("b/t\303\251st.py"), and either side may be quoted
+QUOTED_B_PATH_RE = re.compile(r' "b/((?:[^"\\]|\\.)*)"$')
+QUOTED_A_PATH_RE = re.compile(r'"a/(?:[^"\\]|\\.)*" b/(.*)$')
+# PRs with fewer changed lines than this outside documentation and
+# generated files skip the LLM
+DOC_EXTENSIONS = ('.md', '.rst', '.txt')
+# .txt files that are build or dependency inputs rather than documentation
+NON_DOC_PATTERNS = ('requirements*.txt', 'constraints*.txt', 'CMakeLists.txt')
+TRIVIAL_CHANGE_LINES = 5
+
+# Everything invariant across PRs lives in the system prompt so it forms a
+# stable prefix for OpenAI's automatic prompt caching; only per-PR data goes
+# in the user message
+SYSTEM_PROMPT = """You are a concise, structured PR reviewer.
+
+You will be given a pull request's title and description, its unified diff, and its Change Summary table. Respond with the following sections, using these exact headings:
+
+### 2️⃣ PR Overview
+Analyze the diff and describe the primary objectives of this PR, noting any file additions or deletions, and summarizing the expected impact on functionality, performance, and maintainability.
+
+### 3️⃣ File-level Changes
+For each file in the Change Summary, provide bullet points detailing key modifications, additions, and deletions. Include brief code snippets from the diff for context.
+
+### 4️⃣ Recommendations / Improvements
+Based on the diff, suggest actionable recommendations such as adding null checks, improving validation, refactoring duplicated logic, and updating documentation or tests.
+
+Lines of the form "<N lines truncated>" or "<N files truncated>" mark diff content that was omitted for length."""
+REVIEW_SECTIONS = ("2️⃣ PR Overview", "3️⃣ File-level Changes", "4️⃣ Recommendations / Improvements")
+SECTION_RE = re.compile(r"### (\d️⃣ [^\n]+)\n([\s\S]*?)(?=### \d️⃣|\Z)")
+TABLE_HEADER = (
+    "| File                 | +Adds | -Removes | ΔTotal |",
+    "|:---------------------|:-----:|:--------:|:------:|",
+)
+
+IN_PROGRESS_COMMENT = "## 🤖 Code Review Summary\n\n_Review in progress…_"
+FAILED_COMMENT = "## 🤖 Code Review Summary\n\n_Review failed, see the workflow logs._"
+
+_CLIENT = None
+_CLIENT_LOCK = threading.Lock()
+
+# One pooled session for all GitHub calls so the TLS connection is reused.
+# requests already advertises gzip/deflate and decompresses streamed bodies,
+# so no Accept-Encoding override is needed.
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
+if os.environ.get('GITHUB_TOKEN'):
+    _SESSION.headers['Authorization'] = f"token {os.environ['GITHUB_TOKEN']}"
+
+
+def get_client():
+    """
+    Return the shared OpenAI client, importing and constructing it on first
+    use. `fetch_pr_files` warms it on a worker thread when the review will
+    need the model, so the slow openai import overlaps with the diff download.
+    """
+    global _CLIENT
+    with _CLIENT_LOCK:
+        if _CLIENT is None:
+            from openai import OpenAI
+            _CLIENT = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+    return _CLIENT
 
 
 def get_pr_diff(pr_number):
-    """Fetch the unified diff for the given pull request."""
-    token = os.environ['GITHUB_TOKEN']
+    """Stream the unified diff for the given pull request as decoded text chunks."""
     repo = os.environ['GITHUB_REPOSITORY']
-    headers = {
-        'Authorization': f'token {token}',
-        'Accept': 'application/vnd.github.v3.diff'
-    }
+    headers = {'Accept': 'application/vnd.github.v3.diff'}
     url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}"
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.text
+    with _SESSION.get(url, headers=headers, stream=True) as response:
+        response.raise_for_status()
+        response.encoding = 'utf-8'
+        yield from response.iter_content(chunk_size=65536, decode_unicode=True)
 
 
-def analyze_code_changes(diff_text):
+def get_pr_files(pr_number):
+    """List the files changed by the pull request, following pagination."""
+    repo = os.environ['GITHUB_REPOSITORY']
+    headers = {'Accept': 'application/vnd.github.v3+json'}
+    url = f"https://api.github.com/repos/{repo}/pulls/{pr_number}/files"
+    pr_files = []
+    page = 1
+    while True:
+        response = _SESSION.get(url, headers=headers, params={'per_page': 100, 'page': page})
+        response.raise_for_status()
+        batch = response.json()
+        pr_files.extend(batch)
+        if len(batch) < 100:
+            return pr_files
+        page += 1
+
+
+def fetch_pr_files(pr_number):
     """
-    Generate a structured PR summary with dynamic content:
-    Sections are collapsible per <details> tag:
-    1️⃣ Change Summary (table)
-    2️⃣ PR Overview
-    3️⃣ File-level Changes
-    4️⃣ Recommendations / Improvements
+    Fetch the PR file list and, unless it already shows the LLM review will
+    be skipped, warm the OpenAI client. Errors from either surface through
+    the caller's future.
     """
-    # Parse diff into per-file stats
-    files = {}
-    current = None
-    for line in diff_text.splitlines():
-        if line.startswith('diff --git'):
-            parts = line.split()
-            path = parts[2][2:]
-            current = path
-            files[path] = {'adds': 0, 'removes': 0, 'hunks': []}
-        elif current:
-            files[current]['hunks'].append(line)
-            if line.startswith('+') and not line.startswith('+++'):
-                files[current]['adds'] += 1
-            elif line.startswith('-') and not line.startswith('---'):
-                files[current]['removes'] += 1
-        if line.startswith('new file mode') and current:
-            files[current]['added'] = True
-        if line.startswith('deleted file mode') and current:
-            files[current]['deleted'] = True
-
-    # Exclude .github folder changes
-    files = {p: stats for p, stats in files.items() if not p.startswith('.github/')}
-
-    # 1️⃣ Change Summary table
-    summary_rows = []
-    total_adds = total_removes = 0
-    for path, stats in files.items():
-        name = os.path.basename(path)
-        adds, rem = stats['adds'], stats['removes']
-        total = adds + rem
-        total_adds += adds
-        total_removes += rem
-        summary_rows.append(f"| `{name}` | {adds:>4} | {rem:>4} | {total:>5} |")
-    change_summary = (
-        "| File                 | +Adds | -Removes | ΔTotal |\n"
-        "|:---------------------|:-----:|:--------:|:------:|\n"
-        + "\n".join(summary_rows)
-        + f"\n| **Total**            | {total_adds:>4} | {total_removes:>4} | {(total_adds+total_removes):>5} |"
-    )
+    pr_files = get_pr_files(pr_number)
+    if skip_review_note(merge_pr_files({}, pr_files)) is None:
+        get_client()
+    return pr_files
+
+
+def review_cache_key(request):
+    """Content-addressed key for a chat completion request (model, messages and sampling parameters)."""
+    payload = json.dumps({'version': PROMPT_VERSION, **request}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def load_cached_review(key):
+    """Return the cached LLM body for key, or None on a miss or once it is older than CACHE_TTL."""
+    path = os.path.join(CACHE_DIR, f"{key}.md")
+    try:
+        if time.time() - os.path.getmtime(path) > CACHE_TTL:
+            return None
+        with open(path, encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def prune_review_cache():
+    """Delete cache entries older than CACHE_TTL so restored caches don't grow without bound."""
+    cutoff = time.time() - CACHE_TTL
+    with os.scandir(CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.name.endswith('.md') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
 
-    # Filter diff for prompt (exclude .github)
-    filtered_diff = []
-    skip = False
-    for line in diff_text.splitlines():
-        if line.startswith('diff --git'):
-            parts = line.split()
-            path_b = parts[2][2:]
-            skip = path_b.startswith('.github/')
-            if not skip:
-                filtered_diff.append(line)
+
+def store_cached_review(key, body):
+    """Persist an LLM body so identical diffs skip the OpenAI call, dropping expired entries."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    prune_review_cache()
+    with open(os.path.join(CACHE_DIR, f"{key}.md"), "w", encoding="utf-8") as f:
+        f.write(body)
+
+
+def summary_cache_key(pull_request, description):
+    """
+    Key for the finished comment on a PR head commit. Everything besides
+    the diff that shapes the review is part of it: the description, the
+    system prompt, the strategy, the models and the prompt budgets.
+    """
+    return review_cache_key({
+        'head': pull_request['head']['sha'],
+        'description': description,
+        'system': SYSTEM_PROMPT,
+        'strategy': REVIEW_STRATEGY,
+        'models': [MODEL, SMALL_MODEL, SMALL_DIFF_LINES, MIN_OUTPUT_TOKENS, MAX_OUTPUT_TOKENS, TEMPERATURE],
+        'budgets': [
+            MAX_HUNK_LINES, MAX_HUNK_BYTES, MAX_PROMPT_TOKENS, CHARS_PER_TOKEN,
+            MIN_SNIPPET_LINES, COMPACT_HUNK_LINES, MAX_HEADER_LINES, TRIVIAL_CHANGE_LINES,
+        ],
+        'patterns': [GENERATED_PATTERNS, DOC_EXTENSIONS, NON_DOC_PATTERNS],
+    })
+
+
+def header_path(line):
+    """
+    Post-image (b/) path named by a `diff --git` line, with git's quoting
+    undone. Deleted files name the same path on both sides, so this is the
+    path GitHub's file list reports for every status.
+    """
+    rest = line[len('diff --git '):].rstrip('\r')
+    m = QUOTED_B_PATH_RE.search(rest)
+    if m:
+        return codecs.escape_decode(m.group(1).encode('utf-8'))[0].decode('utf-8', 'replace')
+    m = QUOTED_A_PATH_RE.match(rest)
+    if m:
+        return m.group(1)
+    # Unless the file was renamed, `a/P b/P` splits evenly, which stays
+    # correct when P itself contains " b/"
+    half = (len(rest) - 1) // 2
+    if rest[half:half + 3] == ' b/' and rest[2:half] == rest[half + 3:]:
+        return rest[half + 3:]
+    return rest[rest.rindex(' b/') + 3:]
+
+
+def header_offsets(data, end):
+    """Yield the offsets of `diff --git` lines in data[:end], which starts on a line boundary."""
+    if data.startswith('diff --git ', 0, end):
+        yield 0
+    pos = data.find('\ndiff --git ', 0, end)
+    while pos != -1:
+        yield pos + 1
+        pos = data.find('\ndiff --git ', pos + 1, end)
+
+
+def new_file_buffer():
+    """Per-file accumulator used while splitting the diff stream."""
+    return {'head': [], 'size': 0, 'lines': 0, 'rest': 0}
+
+
+def add_segment(buf, segment):
+    """
+    Add a run of complete lines to a file buffer. Once the buffer holds more
+    than the prompt could ever use, further segments are only counted.
+    """
+    if buf['lines'] > MAX_HEADER_LINES + MAX_HUNK_LINES or buf['size'] > 2 * MAX_HUNK_BYTES:
+        buf['rest'] += segment.count('\n')
+    else:
+        buf['head'].append(segment)
+        buf['size'] += len(segment)
+        buf['lines'] += segment.count('\n')
+
+
+def iter_file_diffs(diff_chunks):
+    """
+    Split a streamed diff per file, yielding (path, head, rest_lines) and
+    skipping .github/ paths. `head` is the start of the file's diff text and
+    `rest_lines` counts the lines after it that were not kept.
+
+    File headers are located with str.find over each chunk, so content lines
+    are never visited individually in Python. Only complete lines are
+    scanned; a trailing partial line is carried into the next chunk.
+    Memory per file is bounded by the head, not the file's diff size.
+    """
+    path = None
+    buf = None
+    carry = []
+    for chunk in diff_chunks:
+        cut = chunk.rfind('\n') + 1
+        if not cut:
+            carry.append(chunk)
+            continue
+        # Scan data[:end] in place rather than slicing off the partial tail
+        if carry:
+            data = ''.join(carry) + chunk
+            end = len(data) - len(chunk) + cut
         else:
-            if not skip:
-                filtered_diff.append(line)
-    filtered_diff_text = "\n".join(filtered_diff)
-
-    # Build prompt for sections 2-4
-    prompt = (
-        "### 2️⃣ PR Overview\n"
-        "Analyze the diff above and describe the primary objectives of this PR, noting any file additions or deletions, and summarizing the expected impact on functionality, performance, and maintainability.\n\n"
-        "### 3️⃣ File-level Changes\n"
-        "For each file in the Change Summary, provide bullet points detailing key modifications, additions, and deletions. Include brief code snippets from the diff for context.\n\n"
-        "### 4️⃣ Recommendations / Improvements\n"
-        "Based on the diff, suggest actionable recommendations such as adding null checks, improving validation, refactoring duplicated logic, and updating documentation or tests.\n\n"
-        "### Full Diff\n"
-        f"```diff\n{filtered_diff_text}\n```"
+            data, end = chunk, cut
+        carry = [chunk[cut:]] if cut < len(chunk) else []
+        start = 0
+        for offset in header_offsets(data, end):
+            if path is not None:
+                add_segment(buf, data[start:offset])
+                yield path, ''.join(buf['head']).removesuffix('\n'), buf['rest']
+            start = offset
+            path = header_path(data[start:data.index('\n', start)])
+            if path.startswith(EXCLUDED_PREFIX):
+                path = None
+            buf = new_file_buffer()
+        if path is not None:
+            add_segment(buf, data[start:end])
+    if path is not None:
+        if carry:
+            add_segment(buf, ''.join(carry) + '\n')
+        yield path, ''.join(buf['head']).removesuffix('\n'), buf['rest']
+
+
+def is_generated(base):
+    """Whether a file name matches GENERATED_PATTERNS."""
+    return any(fnmatch.fnmatch(base, pat) for pat in GENERATED_PATTERNS)
+
+
+def is_doc(path):
+    """Whether a path is documentation: a DOC_EXTENSIONS file not matching NON_DOC_PATTERNS."""
+    base = path.rpartition('/')[2]
+    return path.endswith(DOC_EXTENSIONS) and not any(fnmatch.fnmatch(base, pat) for pat in NON_DOC_PATTERNS)
+
+
+def file_stats(path, text, rest_lines=0):
+    """
+    Keep a truncated copy of one file's diff lines for the prompt: the
+    `diff --git` line, any informative extended headers (file mode, rename,
+    binary notes), and the first MAX_HUNK_LINES / MAX_HUNK_BYTES of hunks.
+
+    Only the head of the text is split into lines; the remainder is just
+    counted and added to `rest_lines` (lines the splitter already dropped),
+    so the work per file is bounded regardless of its size.
+
+    Addition/deletion counts start at zero and are filled in from GitHub's
+    file list by `merge_pr_files`, so the diff text is never scanned for them.
+    """
+    limit = MAX_HEADER_LINES + MAX_HUNK_LINES
+    lines = text.split('\n', limit)
+    if len(lines) > limit:
+        rest_lines += lines.pop().count('\n') + 1
+    stats = {'adds': 0, 'removes': 0, 'base': path.rpartition('/')[2]}
+
+    # index/---/+++ lines only repeat what the diff --git line already says.
+    # Extended headers never run past a handful of lines before the first hunk.
+    header_end = min(len(lines), MAX_HEADER_LINES)
+    body_start = 1
+    while body_start < header_end and not lines[body_start].startswith('@@'):
+        body_start += 1
+    hunks = [lines[0]]
+    hunks.extend(line for line in lines[1:body_start] if not line.startswith(REDUNDANT_HEADER_PREFIXES))
+
+    keep = 0
+    if not is_generated(stats['base']):
+        size = 0
+        for line in lines[body_start:body_start + MAX_HUNK_LINES]:
+            size += len(line) + 1
+            if size > MAX_HUNK_BYTES:
+                break
+            keep += 1
+    hunks.extend(lines[body_start:body_start + keep])
+    stats['hunks'] = hunks
+    stats['omitted'] = len(lines) - body_start - keep + rest_lines
+    return stats
+
+
+def parse_diff(diff_chunks):
+    """Split a streamed unified diff into per-file prompt hunks, skipping .github/ paths."""
+    return {path: file_stats(path, head, rest) for path, head, rest in iter_file_diffs(diff_chunks)}
+
+
+def merge_pr_files(files, pr_files):
+    """
+    Fill in per-file additions/deletions from GitHub's file list, adding any
+    file the diff did not include. Both sides are keyed on the post-image
+    path, so renamed files line up and the .github/ filter agrees with the
+    diff's. Returns the merged mapping.
+    """
+    for entry in pr_files:
+        path = entry['filename']
+        if path.startswith(EXCLUDED_PREFIX):
+            continue
+        stats = files.get(path)
+        if stats is None:
+            stats = files[path] = {
+                'base': path.rpartition('/')[2],
+                'hunks': [f"diff --git a/{path} b/{path}"],
+                'omitted': entry['changes'],
+            }
+        stats['adds'] = entry['additions']
+        stats['removes'] = entry['deletions']
+    return files
+
+
+def build_summary_table(files):
+    """Render the 1️⃣ Change Summary markdown table."""
+    summary_rows = [
+        "| `%s` | %4d | %4d | %5d |" % (stats['base'], stats['adds'], stats['removes'], stats['adds'] + stats['removes'])
+        for stats in files.values()
+    ]
+    total_adds = sum(stats['adds'] for stats in files.values())
+    total_removes = sum(stats['removes'] for stats in files.values())
+    return "\n".join([
+        *TABLE_HEADER,
+        *summary_rows,
+        "| **Total**            | %4d | %4d | %5d |" % (total_adds, total_removes, total_adds + total_removes),
+    ])
+
+
+def describe_pr(pull_request):
+    """Title and (capped) description of the PR from the event payload, for prompt context."""
+    body = (pull_request.get('body') or '').strip()
+    if len(body) > MAX_DESCRIPTION_CHARS:
+        body = body[:MAX_DESCRIPTION_CHARS] + " <description truncated>"
+    return f"Title: {pull_request.get('title', '')}\n\n{body}".rstrip()
+
+
+def cap_summary_table(table, max_chars):
+    """Keep the header, totals row and as many leading file rows of a summary table as fit in max_chars."""
+    if len(table) <= max_chars:
+        return table
+    rows = table.split('\n')
+    header, body, totals = rows[:len(TABLE_HEADER)], rows[len(TABLE_HEADER):-1], rows[-1]
+    # Reserve room for the "more files" row at its longest
+    size = sum(len(row) + 1 for row in header) + len(f"| <{len(body)} more files> | | | |") + 1 + len(totals)
+    keep = 0
+    for row in body:
+        size += len(row) + 1
+        if size > max_chars:
+            break
+        keep += 1
+    return "\n".join([*header, *body[:keep], f"| <{len(body) - keep} more files> | | | |", totals])
+
+
+def build_prompt(files, change_summary, description=""):
+    """Build the per-PR user message: the PR description, truncated diff and Change Summary."""
+    # The description and table count against the prompt budget too; on
+    # very wide PRs the table itself is capped to half of it
+    change_summary = cap_summary_table(change_summary, MAX_PROMPT_TOKENS * CHARS_PER_TOKEN // 2)
+    budget_chars = max(0, MAX_PROMPT_TOKENS * CHARS_PER_TOKEN - len(change_summary) - len(description))
+
+    # If the per-file hunks together exceed the remaining budget, scale every
+    # file down proportionally (keeping at least its header line or two)
+    total_chars = sum(len(line) + 1 for stats in files.values() for line in stats['hunks'])
+    scale = budget_chars / total_chars if total_chars > budget_chars else 1
+
+    keep = {
+        path: len(stats['hunks']) if scale == 1
+        else min(len(stats['hunks']), max(MIN_SNIPPET_LINES, int(len(stats['hunks']) * scale)))
+        for path, stats in files.items()
+    }
+
+    # PRs touching many files can exceed the budget even at MIN_SNIPPET_LINES
+    # per file, so include files by changed lines, largest first, while they fit
+    included = set()
+    remaining = budget_chars
+    for path in sorted(files, key=lambda p: files[p]['adds'] + files[p]['removes'], reverse=True):
+        size = sum(len(line) + 1 for line in files[path]['hunks'][:keep[path]])
+        if files[path]['omitted'] + len(files[path]['hunks']) > keep[path]:
+            size += len("<NNNNN lines truncated>") + 1
+        if size <= remaining or not included:
+            included.add(path)
+            remaining -= size
+
+    # Rebuild the diff from the truncated per-file hunks, marking elided content
+    prompt_diff = []
+    for path, stats in files.items():
+        if path not in included:
+            continue
+        hunks = stats['hunks']
+        prompt_diff.extend(hunks[:keep[path]])
+        omitted = stats['omitted'] + len(hunks) - keep[path]
+        if omitted:
+            prompt_diff.append(f"<{omitted} lines truncated>")
+    if len(included) < len(files):
+        prompt_diff.append(f"<{len(files) - len(included)} files truncated>")
+
+    # The diff lines are spliced in directly so the diff is only copied
+    # once, by the final join. Data is ordered from most to least stable
+    # across pushes (description, diff, totals table) so more of the prompt
+    # prefix is reusable by OpenAI's prompt cache.
+    return "\n".join([
+        "### Pull Request",
+        description,
+        "",
+        "### Full Diff",
+        "```diff",
+        *prompt_diff,
+        "```",
+        "",
+        "### Change Summary",
+        change_summary,
+    ])
+
+
+def build_compact_prompt(files, change_summary, description=""):
+    """Like `build_prompt`, but with only the first COMPACT_HUNK_LINES of each file's diff."""
+    compact = {
+        path: {
+            **stats,
+            'hunks': stats['hunks'][:COMPACT_HUNK_LINES],
+            'omitted': stats['omitted'] + max(0, len(stats['hunks']) - COMPACT_HUNK_LINES),
+        }
+        for path, stats in files.items()
+    }
+    return build_prompt(compact, change_summary, description)
+
+
+# Prompt builders selectable through the REVIEW_STRATEGY environment variable
+PROMPT_STRATEGIES = {
+    'full-diff': build_prompt,
+    'compact': build_compact_prompt,
+}
+if REVIEW_STRATEGY not in PROMPT_STRATEGIES:
+    # Fail before any comment is posted or the diff is downloaded
+    raise ValueError(
+        f"Unknown REVIEW_STRATEGY {REVIEW_STRATEGY!r}; expected one of: {', '.join(PROMPT_STRATEGIES)}"
     )
 
-    client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": "You are a concise, structured PR reviewer."},
+
+def call_llm(prompt, changed_lines):
+    """
+    Return (body, finished) for the model's response to prompt, served from
+    the review cache when possible. Small diffs go to SMALL_MODEL and the
+    output budget scales with the number of changed lines. `finished` is
+    False when the response was cut off at max_tokens; such bodies are not
+    cached.
+    """
+    request = {
+        'model': SMALL_MODEL if changed_lines < SMALL_DIFF_LINES else MODEL,
+        'messages': [
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
-        ]
+        ],
+        'max_tokens': min(MAX_OUTPUT_TOKENS, MIN_OUTPUT_TOKENS + changed_lines),
+        'temperature': TEMPERATURE,
+    }
+    cache_key = review_cache_key(request) if TEMPERATURE == 0 else None
+    if cache_key:
+        body = load_cached_review(cache_key)
+        if body is not None:
+            return body, True
+
+    stream = get_client().chat.completions.create(**request, stream=True)
+    # Accumulate tokens as they arrive instead of waiting for the full response
+    body_parts = []
+    finish_reason = None
+    for chunk in stream:
+        if chunk.choices:
+            body_parts.append(chunk.choices[0].delta.content or "")
+            finish_reason = chunk.choices[0].finish_reason or finish_reason
+    body = "".join(body_parts)
+    finished = finish_reason != 'length'
+    if cache_key and body and finished:
+        store_cached_review(cache_key, body)
+    return body, finished
+
+
+def code_change_lines(files):
+    """Changed lines outside documentation and generated files, the part of the diff the review is about."""
+    return sum(
+        stats['adds'] + stats['removes']
+        for path, stats in files.items()
+        if not is_doc(path) and not is_generated(stats['base'])
     )
-    body = response.choices[0].message.content
 
-    # Split generated sections
-    sections = {}
-    for m in re.finditer(r"### (\d️⃣ [^\n]+)\n([\s\S]*?)(?=### \d️⃣|\Z)", body):
-        sections[m.group(1)] = m.group(2).strip()
+
+def skip_review_note(files):
+    """Return a note explaining why the LLM review is skipped, or None to run it."""
+    if not files:
+        return f"_No reviewable changes outside `{EXCLUDED_PREFIX}` — skipped LLM review._"
+    if all(is_doc(path) for path in files):
+        return "_Docs-only change — skipped LLM review._"
+    if all(is_doc(path) or is_generated(stats['base']) for path, stats in files.items()):
+        return "_Only generated or documentation files changed — skipped LLM review._"
+    if code_change_lines(files) < TRIVIAL_CHANGE_LINES:
+        return f"_Trivial change (fewer than {TRIVIAL_CHANGE_LINES} changed lines of code) — skipped LLM review._"
+    return None
+
+
+def analyze_code_changes(files, description=""):
+    """
+    Generate a structured PR summary with dynamic content:
+    Sections are collapsible per <details> tag:
+    1️⃣ Change Summary (table)
+    2️⃣ PR Overview
+    3️⃣ File-level Changes
+    4️⃣ Recommendations / Improvements
+
+    `files` is the per-file stats mapping produced by `parse_diff`;
+    `description` is optional PR context from `describe_pr`.
+
+    Returns (comment, complete), where `complete` is False when the model
+    returned nothing or was cut off, so the comment is not worth caching.
+    """
+    change_summary = build_summary_table(files)
 
     # Build collapsible output
     output = []
@@ -122,8 +595,25 @@ def analyze_code_changes(diff_text):
     output.append(change_summary)
     output.append("</details>")
 
+    # Empty, docs-only and trivial PRs are not worth an LLM round trip
+    skip_note = skip_review_note(files)
+    if skip_note:
+        output.append("")
+        output.append(skip_note)
+        return "\n".join(output), True
+
+    # Lockfile bumps and docs shouldn't push a small code change onto the
+    # large model or inflate its output budget
+    prompt = PROMPT_STRATEGIES[REVIEW_STRATEGY](files, change_summary, description)
+    body, finished = call_llm(prompt, code_change_lines(files))
+
+    # Split generated sections
+    sections = {}
+    for m in SECTION_RE.finditer(body):
+        sections[m.group(1)] = m.group(2).strip()
+
     # Sections 2-4
-    for sec in ["2️⃣ PR Overview", "3️⃣ File-level Changes", "4️⃣ Recommendations / Improvements"]:
+    for sec in REVIEW_SECTIONS:
         content = sections.get(sec, None)
         if content:
             output.append("")
@@ -133,26 +623,89 @@ def analyze_code_changes(diff_text):
             output.append(content)
             output.append("</details>")
 
-    return "\n".join(output)
+    # If the model ignored the expected headings, show its answer as-is
+    # rather than discarding a response we already paid for
+    if not any(sections.get(sec) for sec in REVIEW_SECTIONS) and body.strip():
+        output.append("")
+        output.append("<details>")
+        output.append("<summary>Review</summary>")
+        output.append("")
+        output.append(body.strip())
+        output.append("</details>")
+
+    if not finished:
+        output.append("")
+        output.append("_The review was cut off at the output token limit._")
+
+    return "\n".join(output), finished and bool(body.strip())
+
+
+def comment_payload(comment):
+    """
+    Serialize a comment body once to raw UTF-8 JSON rather than letting
+    requests escape every emoji/non-ASCII character as \\uXXXX.
+    """
+    return json.dumps({'body': comment}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
 
 
 def post_pr_comment(pr_number, comment):
-    token = os.environ['GITHUB_TOKEN']
     repo = os.environ['GITHUB_REPOSITORY']
-    headers = {'Authorization': f'token {token}', 'Accept': 'application/vnd.github.v3+json'}
+    headers = {'Accept': 'application/vnd.github.v3+json', 'Content-Type': 'application/json'}
     url = f"https://api.github.com/repos/{repo}/issues/{pr_number}/comments"
-    res = requests.post(url, headers=headers, json={'body': comment})
+    res = _SESSION.post(url, headers=headers, data=comment_payload(comment))
+    res.raise_for_status()
+    return res.json()
+
+
+def update_pr_comment(comment_id, comment):
+    """Replace the body of an existing PR comment."""
+    repo = os.environ['GITHUB_REPOSITORY']
+    headers = {'Accept': 'application/vnd.github.v3+json', 'Content-Type': 'application/json'}
+    url = f"https://api.github.com/repos/{repo}/issues/comments/{comment_id}"
+    res = _SESSION.patch(url, headers=headers, data=comment_payload(comment))
     res.raise_for_status()
     return res.json()
 
 
 def main():
+    if not os.environ.get('GITHUB_TOKEN'):
+        raise SystemExit("GITHUB_TOKEN must be set to read the PR and post the review")
     with open(os.environ['GITHUB_EVENT_PATH']) as f:
         event = json.load(f)
-    pr_num = event['pull_request']['number']
-    diff = get_pr_diff(pr_num)
-    summary = analyze_code_changes(diff)
-    post_pr_comment(pr_num, summary)
+    pull_request = event['pull_request']
+    pr_num = pull_request['number']
+    description = describe_pr(pull_request)
+
+    # A rerun for an already reviewed head commit reposts that review
+    # without downloading the diff or file list
+    summary_key = summary_cache_key(pull_request, description)
+    cached = load_cached_review(summary_key)
+    if cached is not None:
+        post_pr_comment(pr_num, cached)
+        return
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        # The placeholder comment, the file list and (when needed) the OpenAI
+        # client are set up in the background while the diff streams in
+        placeholder = pool.submit(post_pr_comment, pr_num, IN_PROGRESS_COMMENT)
+        pr_files = pool.submit(fetch_pr_files, pr_num)
+        try:
+            files = parse_diff(get_pr_diff(pr_num))
+            # Don't pay for the model if the comment could not be posted
+            # (e.g. a fork PR's read-only token)
+            comment_id = placeholder.result()['id']
+            files = merge_pr_files(files, pr_files.result())
+            summary, complete = analyze_code_changes(files, description)
+        except Exception:
+            # Only a placeholder that was actually created is marked failed,
+            # so its own error never masks the original one
+            if placeholder.exception() is None:
+                update_pr_comment(placeholder.result()['id'], FAILED_COMMENT)
+            raise
+        update_pr_comment(comment_id, summary)
+    # An empty completion is left uncached so a rerun retries the model
+    if complete:
+        store_cached_review(summary_key, summary)
 
 if __name__ == "__main__":
     main()
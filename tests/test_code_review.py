@@ -0,0 +1,373 @@
+import os
+import random
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '.github', 'scripts'))
+
+import code_review  # noqa: E402
+
+
+def test_header_path_plain_with_space():
+    line = "diff --git a/src/my file.py b/src/my file.py"
+    assert code_review.header_path(line) == "src/my file.py"
+
+
+def test_header_path_containing_b_slash():
+    line = "diff --git a/x b/y.py b/x b/y.py"
+    assert code_review.header_path(line) == "x b/y.py"
+    files = code_review.merge_pr_files(
+        code_review.parse_diff([line + "\n@@ -1 +1 @@\n-a\n+b\n"]),
+        [{'filename': 'x b/y.py', 'additions': 1, 'deletions': 1, 'changes': 2, 'status': 'modified'}],
+    )
+    assert list(files) == ['x b/y.py']
+
+
+def test_header_path_quoted_non_ascii():
+    line = 'diff --git "a/t\\303\\251st.py" "b/t\\303\\251st.py"'
+    assert code_review.header_path(line) == "tést.py"
+
+
+def test_header_path_is_the_post_image_side_of_a_rename():
+    assert code_review.header_path("diff --git a/old.py b/pkg/new.py") == "pkg/new.py"
+    assert code_review.header_path('diff --git a/old.py "b/n\\303\\251w.py"') == "néw.py"
+    assert code_review.header_path('diff --git "a/\\303\\251ld.py" b/new.py') == "new.py"
+
+
+def test_quoted_path_merges_with_pr_files():
+    diff = (
+        'diff --git "a/t\\303\\251st.py" "b/t\\303\\251st.py"\n'
+        "index 1..2 100644\n"
+        '--- "a/t\\303\\251st.py"\n'
+        '+++ "b/t\\303\\251st.py"\n'
+        "@@ -1 +1 @@\n"
+        "-old\n"
+        "+new\n"
+    )
+    files = code_review.parse_diff([diff])
+    pr_files = [{'filename': "tést.py", 'additions': 1, 'deletions': 1, 'changes': 2, 'status': 'modified'}]
+    files = code_review.merge_pr_files(files, pr_files)
+    assert list(files) == ["tést.py"]
+    assert files["tést.py"]['adds'] == 1
+    assert "+new" in files["tést.py"]['hunks']
+
+
+def test_generated_files_do_not_count_toward_model_routing(monkeypatch):
+    calls = []
+
+    def fake_call_llm(prompt, changed_lines):
+        calls.append(changed_lines)
+        return "", True
+
+    monkeypatch.setattr(code_review, 'call_llm', fake_call_llm)
+    files = {
+        'a.py': {'base': 'a.py', 'adds': 6, 'removes': 3, 'hunks': ["diff --git a/a.py b/a.py"], 'omitted': 9},
+        'package-lock.json': {
+            'base': 'package-lock.json', 'adds': 3000, 'removes': 0,
+            'hunks': ["diff --git a/package-lock.json b/package-lock.json"], 'omitted': 3000,
+        },
+    }
+    code_review.analyze_code_changes(files)
+    assert calls == [9]
+
+
+def test_empty_completion_is_not_complete(monkeypatch):
+    monkeypatch.setattr(code_review, 'call_llm', lambda prompt, changed_lines: ("", True))
+    files = {'a.py': {'base': 'a.py', 'adds': 20, 'removes': 0, 'hunks': ["diff --git a/a.py b/a.py"], 'omitted': 20}}
+    comment, complete = code_review.analyze_code_changes(files)
+    assert not complete
+    assert "1️⃣ Change Summary" in comment
+
+
+def test_summary_cache_key_tracks_system_prompt(monkeypatch):
+    pull_request = {'head': {'sha': 'abc123'}}
+    key = code_review.summary_cache_key(pull_request, "Title: x")
+    monkeypatch.setattr(code_review, 'SYSTEM_PROMPT', code_review.SYSTEM_PROMPT + "\nBe brief.")
+    assert code_review.summary_cache_key(pull_request, "Title: x") != key
+
+
+def test_unknown_review_strategy_fails_at_import():
+    script = os.path.join(os.path.dirname(__file__), '..', '.github', 'scripts', 'code_review.py')
+    env = {**os.environ, 'REVIEW_STRATEGY': 'full_diff'}
+    result = subprocess.run(
+        [sys.executable, '-c', f"import runpy; runpy.run_path({script!r})"],
+        env=env, capture_output=True, text=True,
+    )
+    assert result.returncode != 0
+    assert "expected one of: full-diff, compact" in result.stderr
+
+
+def test_client_is_only_warmed_when_the_review_needs_the_model(monkeypatch):
+    warmed = []
+    monkeypatch.setattr(code_review, 'get_client', lambda: warmed.append(True))
+    docs_only = [{'filename': 'README.md', 'additions': 40, 'deletions': 0, 'changes': 40, 'status': 'modified'}]
+    code = [{'filename': 'a.py', 'additions': 40, 'deletions': 0, 'changes': 40, 'status': 'modified'}]
+
+    monkeypatch.setattr(code_review, 'get_pr_files', lambda pr_number: docs_only)
+    assert code_review.fetch_pr_files(1) == docs_only
+    assert warmed == []
+
+    monkeypatch.setattr(code_review, 'get_pr_files', lambda pr_number: code)
+    code_review.fetch_pr_files(1)
+    assert warmed == [True]
+
+
+def test_renamed_file_is_listed_under_its_new_name():
+    diff = (
+        "diff --git a/old_name.py b/pkg/new_name.py\n"
+        "similarity index 90%\n"
+        "rename from old_name.py\n"
+        "rename to pkg/new_name.py\n"
+        "@@ -1 +1 @@\n"
+        "-a\n"
+        "+b\n"
+        "diff --git a/z.py b/z.py\n"
+        "@@ -1 +1 @@\n"
+        "-a\n"
+        "+b\n"
+    )
+    pr_files = [
+        {'filename': 'pkg/new_name.py', 'previous_filename': 'old_name.py', 'additions': 1, 'deletions': 1,
+         'changes': 2, 'status': 'renamed'},
+        {'filename': 'z.py', 'additions': 1, 'deletions': 1, 'changes': 2, 'status': 'modified'},
+    ]
+    files = code_review.merge_pr_files(code_review.parse_diff([diff]), pr_files)
+    assert list(files) == ['pkg/new_name.py', 'z.py']
+    assert files['pkg/new_name.py']['base'] == 'new_name.py'
+    assert "rename to pkg/new_name.py" in files['pkg/new_name.py']['hunks']
+
+
+def random_diff(rng):
+    """A synthetic diff and, per reviewed file, its number of lines."""
+    out = []
+    line_counts = {}
+    for i in range(rng.randint(1, 6)):
+        path = rng.choice(['', 'src/', '.github/']) + f"f{i}" + rng.choice(['.py', '.lock'])
+        lines = [f"diff --git a/{path} b/{path}", "index 1..2 100644", f"--- a/{path}", f"+++ b/{path}"]
+        for _ in range(rng.randint(0, 3)):
+            lines.append("@@ -1,3 +1,3 @@ ctx")
+            lines += [
+                rng.choice("+- ") + "x" * rng.randint(0, 300) + rng.choice(["", "\r", " diff --git a/x b/x"])
+                for _ in range(rng.randint(0, 250))
+            ]
+        out += lines
+        if not path.startswith(code_review.EXCLUDED_PREFIX):
+            line_counts[path] = len(lines)
+    return "\n".join(out) + rng.choice(["", "\n"]), line_counts
+
+
+def test_parse_diff_is_invariant_to_chunk_size():
+    rng = random.Random(1)
+    for _ in range(50):
+        diff, _ = random_diff(rng)
+        expected = code_review.parse_diff([diff])
+        for size in (1, 7, 64, 1000, 65536):
+            chunks = [diff[i:i + size] for i in range(0, len(diff), size)]
+            assert code_review.parse_diff(chunks) == expected
+
+
+def test_kept_and_omitted_lines_add_up():
+    rng = random.Random(2)
+    for _ in range(50):
+        diff, line_counts = random_diff(rng)
+        files = code_review.parse_diff([diff])
+        assert list(files) == list(line_counts)
+        for path, stats in files.items():
+            # The index/---/+++ headers are the only lines dropped outright
+            assert len(stats['hunks']) + stats['omitted'] + 3 == line_counts[path]
+            assert len(stats['hunks']) <= 1 + code_review.MAX_HUNK_LINES
+
+
+def test_renames_into_and_out_of_github_dir_follow_the_new_path():
+    diff = (
+        "diff --git a/src/x.py b/.github/x.py\n"
+        "rename from src/x.py\n"
+        "rename to .github/x.py\n"
+        "@@ -1 +1 @@\n"
+        "-a\n"
+        "+secret\n"
+        "diff --git a/.github/y.py b/src/y.py\n"
+        "rename from .github/y.py\n"
+        "rename to src/y.py\n"
+        "@@ -1 +1 @@\n"
+        "-a\n"
+        "+visible\n"
+    )
+    pr_files = [
+        {'filename': '.github/x.py', 'previous_filename': 'src/x.py', 'additions': 1, 'deletions': 1,
+         'changes': 2, 'status': 'renamed'},
+        {'filename': 'src/y.py', 'previous_filename': '.github/y.py', 'additions': 1, 'deletions': 1,
+         'changes': 2, 'status': 'renamed'},
+    ]
+    files = code_review.merge_pr_files(code_review.parse_diff([diff]), pr_files)
+    assert list(files) == ['src/y.py']
+    assert "+visible" in files['src/y.py']['hunks']
+    assert files['src/y.py']['adds'] == 1
+
+
+class FakeClient:
+    """Streams `text` in small deltas, ending with `finish_reason`."""
+
+    def __init__(self, text, finish_reason):
+        chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text[i:i + 5]), finish_reason=None)])
+            for i in range(0, len(text), 5)
+        ]
+        chunks.append(SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=None),
+                                                               finish_reason=finish_reason)]))
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=lambda **kw: iter(chunks)))
+
+
+def test_truncated_completion_is_neither_cached_nor_complete(monkeypatch, tmp_path):
+    monkeypatch.setattr(code_review, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(code_review, 'get_client', lambda: FakeClient("### 2️⃣ PR Overview\nHalf a", 'length'))
+    files = {'a.py': {'base': 'a.py', 'adds': 20, 'removes': 0, 'hunks': ["diff --git a/a.py b/a.py"], 'omitted': 20}}
+    comment, complete = code_review.analyze_code_changes(files)
+    assert not complete
+    assert "cut off" in comment
+    assert list(tmp_path.iterdir()) == []
+
+    monkeypatch.setattr(code_review, 'get_client', lambda: FakeClient("### 2️⃣ PR Overview\nDone.", 'stop'))
+    comment, complete = code_review.analyze_code_changes(files)
+    assert complete
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def wide_pr(n_files, lines_per_file):
+    """Per-file stats for n_files changed files, file i changing i + 1 lines."""
+    files = {}
+    for i in range(n_files):
+        path = f"src/module_{i}.py"
+        hunks = [f"diff --git a/{path} b/{path}", "@@ -1 +1 @@"]
+        hunks += [f"+line {j} " + "x" * 60 for j in range(lines_per_file)]
+        files[path] = {'base': path.rpartition('/')[2], 'adds': i + 1, 'removes': 0, 'hunks': hunks, 'omitted': 0}
+    return files
+
+
+def prompt_budget():
+    return code_review.MAX_PROMPT_TOKENS * code_review.CHARS_PER_TOKEN
+
+
+def test_prompt_scales_every_file_down_to_the_budget():
+    files = wide_pr(10, 200)
+    summary = code_review.build_summary_table(files)
+    prompt = code_review.build_prompt(files, summary, "Title: x")
+    assert len(prompt) <= prompt_budget() + 200
+    assert prompt.count("diff --git") == 10
+    assert prompt.count("lines truncated>") == 10
+
+
+def test_prompt_admits_the_largest_files_when_even_snippets_overflow():
+    files = wide_pr(2000, 5)
+    summary = code_review.build_summary_table(files)
+    prompt = code_review.build_prompt(files, summary, "Title: x")
+    assert len(prompt) <= prompt_budget() + 200
+    assert "files truncated>" in prompt
+    assert "diff --git a/src/module_1999.py" in prompt
+    assert "diff --git a/src/module_0.py " not in prompt
+
+
+def test_prompt_caps_a_wide_summary_table():
+    files = wide_pr(3000, 1)
+    summary = code_review.build_summary_table(files)
+    assert len(summary) > prompt_budget()
+    prompt = code_review.build_prompt(files, summary, "Title: x")
+    assert len(prompt) <= prompt_budget() + 200
+    assert "more files> |" in prompt
+    assert summary.rsplit('\n', 1)[1] in prompt
+
+
+def run_main(monkeypatch, tmp_path, post_pr_comment):
+    event = tmp_path / "event.json"
+    event.write_text('{"pull_request": {"number": 7, "title": "t", "body": "", "head": {"sha": "abc"}}}')
+    monkeypatch.setenv('GITHUB_EVENT_PATH', str(event))
+    monkeypatch.setenv('GITHUB_TOKEN', 't')
+    monkeypatch.setattr(code_review, 'CACHE_DIR', str(tmp_path / "cache"))
+    monkeypatch.setattr(code_review, 'post_pr_comment', post_pr_comment)
+    monkeypatch.setattr(code_review, 'fetch_pr_files', lambda pr_number: [])
+    monkeypatch.setattr(code_review, 'get_pr_diff', lambda pr_number: iter(["diff --git a/a.py b/a.py\n"]))
+    updates = []
+    monkeypatch.setattr(code_review, 'update_pr_comment', lambda comment_id, comment: updates.append(comment))
+    analyzed = []
+    monkeypatch.setattr(code_review, 'analyze_code_changes', lambda files, description: analyzed.append(files) or ("x", True))
+    return updates, analyzed
+
+
+def test_failed_placeholder_stops_before_the_model(monkeypatch, tmp_path):
+    def forbidden(pr_number, comment):
+        raise PermissionError("403 Forbidden")
+
+    updates, analyzed = run_main(monkeypatch, tmp_path, forbidden)
+    with pytest.raises(PermissionError, match="403"):
+        code_review.main()
+    assert analyzed == []
+    assert updates == []
+
+
+def test_failure_after_placeholder_marks_it_failed(monkeypatch, tmp_path):
+    updates, analyzed = run_main(monkeypatch, tmp_path, lambda pr_number, comment: {'id': 1})
+
+    def broken_diff(pr_number):
+        raise ConnectionError("diff download failed")
+        yield
+
+    monkeypatch.setattr(code_review, 'get_pr_diff', broken_diff)
+    with pytest.raises(ConnectionError):
+        code_review.main()
+    assert updates == [code_review.FAILED_COMMENT]
+
+
+def test_requirements_files_are_not_documentation():
+    def stats(path, adds):
+        return {'base': path.rpartition('/')[2], 'adds': adds, 'removes': 0}
+
+    assert code_review.skip_review_note({'requirements.txt': stats('requirements.txt', 10)}) is None
+    mixed = {'requirements-dev.txt': stats('requirements-dev.txt', 30), 'a.py': stats('a.py', 2)}
+    assert code_review.code_change_lines(mixed) == 32
+    assert code_review.skip_review_note(mixed) is None
+    assert "Docs-only" in code_review.skip_review_note({'docs/notes.txt': stats('docs/notes.txt', 30)})
+
+
+def single_file_pr():
+    return {'a.py': {'base': 'a.py', 'adds': 20, 'removes': 0, 'hunks': ["diff --git a/a.py b/a.py"], 'omitted': 20}}
+
+
+def test_answer_without_headings_is_kept(monkeypatch):
+    monkeypatch.setattr(code_review, 'call_llm', lambda prompt, changed_lines: ("Looks fine overall.", True))
+    comment, complete = code_review.analyze_code_changes(single_file_pr())
+    assert complete
+    assert "<summary>Review</summary>" in comment
+    assert "Looks fine overall." in comment
+
+
+def test_answer_with_headings_gets_no_fallback_block(monkeypatch):
+    body = "### 2️⃣ PR Overview\nAdds a.\n### 4️⃣ Recommendations / Improvements\n- Test it.\n"
+    monkeypatch.setattr(code_review, 'call_llm', lambda prompt, changed_lines: (body, True))
+    comment, complete = code_review.analyze_code_changes(single_file_pr())
+    assert complete
+    assert "<summary>2️⃣ PR Overview</summary>" in comment
+    assert "<summary>Review</summary>" not in comment
+
+
+def test_storing_a_review_prunes_expired_entries(monkeypatch, tmp_path):
+    monkeypatch.setattr(code_review, 'CACHE_DIR', str(tmp_path))
+    stale = tmp_path / "stale.md"
+    fresh = tmp_path / "fresh.md"
+    stale.write_text("old")
+    fresh.write_text("new")
+    old = time.time() - code_review.CACHE_TTL - 60
+    os.utime(stale, (old, old))
+    code_review.store_cached_review("key", "body")
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["fresh.md", "key.md"]
+
+
+def test_missing_github_token_fails_up_front(monkeypatch, tmp_path):
+    updates, analyzed = run_main(monkeypatch, tmp_path, lambda pr_number, comment: {'id': 1})
+    monkeypatch.delenv('GITHUB_TOKEN')
+    with pytest.raises(SystemExit, match="GITHUB_TOKEN"):
+        code_review.main()
+    assert analyzed == []